@@ -1,11 +1,21 @@
 import streamlit as st
-import json
+import orjson
 import io
 import zipfile
 import time
 import os
+import hashlib
+import re
+import threading
+import numpy as np
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import PIL
 from PIL import Image
+import diskcache
 import google.generativeai as genai
+from google.generativeai import client as genai_client
+from google.api_core import exceptions as google_exceptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
 # ---------------------------------------------------------
 # 頁面基本設定
@@ -23,53 +33,56 @@ st.markdown("上傳報紙圖片 -> AI 自動識別版面與分隔線 -> **下載
 # 核心邏輯函數
 # ---------------------------------------------------------
 
-def crop_image_section(pil_image, box_2d):
+MODEL_NAME = 'gemini-3-pro-preview'
+
+# genai.configure 修改的是全域設定；不同 API Key 的 get_model 可能同時執行，
+# 設定與綁定 client 必須在同一個鎖內完成，模型才不會綁到其他使用者的 Key
+GENAI_CONFIG_LOCK = threading.Lock()
+
+@st.cache_resource
+def get_model(api_key, name=MODEL_NAME):
     """
-    根據 AI 回傳的 [ymin, xmin, ymax, xmax] (0-1000) 裁切圖片。
+    依 API Key 建立並快取 GenerativeModel，避免每次呼叫都重新設定與初始化連線。
     """
-    if not box_2d or len(box_2d) != 4:
-        return None
-        
+    with GENAI_CONFIG_LOCK:
+        genai.configure(api_key=api_key)
+        # 使用 Gemini 1.5 Pro，對於版面分析能力最強
+        model = genai.GenerativeModel(name)
+        # 立即綁定以這把 API Key 建立的 client，之後的請求不再讀取全域設定
+        model._client = genai_client.get_default_generative_client()
+
+    # 以輕量的 count_tokens 預先建立 generate_content 使用的連線 (client 已在鎖內綁定)，
+    # 網路請求不佔用鎖；失敗不影響後續分析
     try:
-        width, height = pil_image.size
-        ymin, xmin, ymax, xmax = box_2d
-        
-        # 轉換座標
-        left = (xmin / 1000) * width
-        top = (ymin / 1000) * height
-        right = (xmax / 1000) * width
-        bottom = (ymax / 1000) * height
-        
-        # 邊界檢查
-        left = max(0, left)
-        top = max(0, top)
-        right = min(width, right)
-        bottom = min(height, bottom)
+        model.count_tokens("ping")
+    except Exception as e:
+        print(f"警告：預先建立 Gemini 連線失敗，錯誤：{e}")
+    return model
 
-        if right <= left or bottom <= top:
-            return None
+# Gemini 回應快取：同一張圖 + 同一份 Prompt + 同一模型直接讀取磁碟結果
+CACHE_DIR = "./.gemini_cache"
+CACHE_EXPIRE_SECONDS = 7 * 86400
 
-        # 裁切並返回 PIL Image 物件
-        return pil_image.crop((left, top, right, bottom))
-    except Exception as e:
-        print(f"警告：圖片裁切失敗，錯誤：{e}")
-        return None
+@st.cache_resource
+def get_response_cache():
+    """
+    開啟 (或建立) 本機磁碟快取，整個伺服器程序共用一個實例。
+    """
+    return diskcache.Cache(CACHE_DIR)
 
-def process_with_gemini(api_key, image_input):
+def build_cache_key(image_bytes, prompt, model_name):
     """
-    呼叫 Gemini API 進行報紙結構化分析。
+    以圖片內容、Prompt 與模型名稱的雜湊值組成快取鍵。
     """
-    try:
-        genai.configure(api_key=api_key)
-        # 使用 Gemini 1.5 Pro，對於版面分析能力最強
-        model = genai.GenerativeModel('gemini-3-pro-preview')
-    except Exception as e:
-        raise ValueError(f"API 設定失敗: {e}")
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return f"{image_hash}_{prompt_hash}_{model_name}"
 
-    # ---------------------------------------------------------
-    # Prompt 定義 (與 Colab 版本一致，包含分隔線與標題處理)
-    # ---------------------------------------------------------
-    prompt = """
+# ---------------------------------------------------------
+# Prompt 定義 (與 Colab 版本一致，包含分隔線與標題處理)
+# 固定放在請求內容的最前面；長度遠低於隱式快取的最低 token 數，實際上不會命中快取
+# ---------------------------------------------------------
+NEWSPAPER_PROMPT = """
     你是一位專業的日文報紙編輯與翻譯專家。
     請分析這張報紙圖片，根據版面上的「分隔線 (Line Separators)」與「空白間距」，將每一則獨立的新聞報導提取出來。
 
@@ -115,11 +128,455 @@ def process_with_gemini(api_key, image_input):
     }
     """
 
+# 多張圖片合併為一次請求時附加在 NEWSPAPER_PROMPT 之後
+MULTI_PAGE_PROMPT_SUFFIX = """
+    **多張圖片 (重要)**：
+    本次請求依序附上 {page_count} 張報紙圖片，請逐張獨立分析，不可跨圖片合併新聞。
+    請改用以下格式輸出，pages 陣列必須恰好有 {page_count} 個元素且順序與圖片相同，
+    每個元素的格式與上方單張圖片的輸出格式完全一致：
+    {{
+      "pages": [
+        {{ "date": "YYYY年MM月DD日", "sections": [ ... ] }}
+      ]
+    }}
+    """
+
+# ---------------------------------------------------------
+# 結構化輸出 Schema (與 Prompt 中的輸出格式一致)
+# 直接以 protos.Schema 定義：SDK 由 TypedDict 轉換時會丟棄 required，
+# 必填欄位與 type 的列舉值只能以這種方式交給 Gemini 的 response_schema 約束
+# ---------------------------------------------------------
+_STRING = genai.protos.Schema(type_=genai.protos.Type.STRING)
+
+SECTION_SCHEMA = genai.protos.Schema(
+    type_=genai.protos.Type.OBJECT,
+    properties={
+        "type": genai.protos.Schema(type_=genai.protos.Type.STRING, format_="enum", enum=["news", "image"]),
+        "box_2d": genai.protos.Schema(
+            type_=genai.protos.Type.ARRAY,
+            items=genai.protos.Schema(type_=genai.protos.Type.INTEGER),
+            min_items=4,
+            max_items=4
+        ),
+        "headline_main_jp": _STRING,
+        "headline_main_zh": _STRING,
+        "headline_sub_jp": _STRING,
+        "headline_sub_zh": _STRING,
+        "body_text_jp": _STRING,
+        "body_text_zh": _STRING,
+        "caption_jp": _STRING,
+        "caption_zh": _STRING,
+    },
+    required=["type", "box_2d"]
+)
+
+PAGE_SCHEMA = genai.protos.Schema(
+    type_=genai.protos.Type.OBJECT,
+    properties={
+        "date": _STRING,
+        "sections": genai.protos.Schema(type_=genai.protos.Type.ARRAY, items=SECTION_SCHEMA),
+    },
+    required=["date", "sections"]
+)
+
+MULTI_PAGE_SCHEMA = genai.protos.Schema(
+    type_=genai.protos.Type.OBJECT,
+    properties={
+        "pages": genai.protos.Schema(type_=genai.protos.Type.ARRAY, items=PAGE_SCHEMA),
+    },
+    required=["pages"]
+)
+
+PAGE_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": PAGE_SCHEMA,
+}
+MULTI_PAGE_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": MULTI_PAGE_SCHEMA,
+}
+
+# JPEG 以 DCT 縮放方式解碼的目標尺寸 (實際尺寸不小於此值)
+DRAFT_SIZE = (2048, 2048)
+
+# 送往 Gemini 的圖片最長邊，超過此尺寸模型內部也會縮小，只是徒增上傳量
+GEMINI_MAX_SIDE = 1568
+
+# 流量限制 (429)、服務暫停 (503)、逾時 (504) 才重試；JSON 解析錯誤等不重試
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    TimeoutError,
+)
+
+def _record_retry(retry_state):
+    """
+    tenacity 重試前的回呼，將錯誤類型記錄到呼叫端傳入的 retry_log。
+    """
+    retry_log = retry_state.kwargs.get("retry_log")
+    if retry_log is not None:
+        retry_log.append(type(retry_state.outcome.exception()).__name__)
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception_type(RETRYABLE_ERRORS),
+    before_sleep=_record_retry,
+    reraise=True
+)
+def generate_with_retry(model, contents, generation_config, retry_log=None):
+    """
+    以串流方式呼叫 model.generate_content 並取得完整回應文字。
+    遇到 429/503/逾時 (包含串流中途中斷) 以指數退避重試。
+    """
     response = model.generate_content(
-        [prompt, image_input],
-        generation_config={"response_mime_type": "application/json"}
+        contents,
+        generation_config=generation_config,
+        stream=True
+    )
+    # 讀完串流後由 SDK 合併各 chunk 的文字；只有結束原因或用量資訊的 chunk 沒有 parts，不能逐一讀取 .text
+    response.resolve()
+    result_text = response.text
+
+    # 只在隱式快取確實命中時記錄，避免每次請求都印出 0 tokens
+    usage = getattr(response, "usage_metadata", None)
+    cached_tokens = getattr(usage, "cached_content_token_count", 0) if usage is not None else 0
+    if cached_tokens > 0:
+        print(f"Gemini 用量：輸入 {usage.prompt_token_count} tokens，其中快取命中 {cached_tokens} tokens")
+    return result_text
+
+def normalize_box(box_2d):
+    """
+    將 AI 回傳的 box_2d 轉為 4 個浮點數；格式不符時回傳 NaN，供批次轉換時過濾。
+    """
+    try:
+        if not box_2d or len(box_2d) != 4:
+            return [np.nan] * 4
+        return [float(v) for v in box_2d]
+    except (TypeError, ValueError):
+        return [np.nan] * 4
+
+def boxes_to_pixels(boxes_1000, width, height):
+    """
+    將 N 個 [ymin, xmin, ymax, xmax] (0-1000) 一次轉換為 PIL 裁切用的
+    (left, top, right, bottom) 像素座標，並回傳有效區塊的布林遮罩。
+    """
+    boxes = np.asarray(boxes_1000, dtype=np.float64).reshape(-1, 4)
+    scale = np.array([height, width, height, width]) / 1000.0
+    ymin, xmin, ymax, xmax = (boxes * scale).T
+
+    # 邊界檢查
+    pixel_boxes = np.rint(np.stack([
+        np.clip(xmin, 0, width),
+        np.clip(ymin, 0, height),
+        np.clip(xmax, 0, width),
+        np.clip(ymax, 0, height),
+    ], axis=1))
+
+    # 過濾格式錯誤 (NaN) 與寬高為 0 的區塊
+    valid = (
+        np.isfinite(pixel_boxes).all(axis=1)
+        & (pixel_boxes[:, 2] > pixel_boxes[:, 0])
+        & (pixel_boxes[:, 3] > pixel_boxes[:, 1])
     )
-    return response.text
+    pixel_boxes = np.where(valid[:, None], pixel_boxes, 0).astype(np.int32)
+    return pixel_boxes, valid
+
+def section_pixel_boxes(sections, image_size):
+    """
+    一次計算所有區塊的像素座標，回傳與 sections 等長的 list，無效區塊為 None。
+    """
+    if not sections:
+        return []
+    width, height = image_size
+    boxes = [normalize_box(section.get('box_2d')) for section in sections]
+    pixel_boxes, valid = boxes_to_pixels(boxes, width, height)
+    return [
+        tuple(box) if ok else None
+        for box, ok in zip(pixel_boxes.tolist(), valid.tolist())
+    ]
+
+def crop_pixel_box(pil_image, pixel_box):
+    """
+    依 (left, top, right, bottom) 像素座標裁切圖片，失敗時回傳 None。
+    """
+    if pixel_box is None:
+        return None
+
+    try:
+        # 裁切並返回 PIL Image 物件
+        return pil_image.crop(pixel_box)
+    except Exception as e:
+        print(f"警告：圖片裁切失敗，錯誤：{e}")
+        return None
+
+def crop_to_jpeg_bytes(pil_image, pixel_box):
+    """
+    依像素座標裁切區塊並一次編碼為 JPEG bytes，裁切失敗時回傳 None。
+    """
+    cropped_img = crop_pixel_box(pil_image, pixel_box)
+    if cropped_img is None:
+        return None
+
+    # PNG/WEBP 可能帶有透明通道，JPEG 無法直接儲存
+    if cropped_img.mode not in ("RGB", "L"):
+        cropped_img = cropped_img.convert("RGB")
+
+    # 明確指定編碼參數：單次 Huffman、非漸進式、4:2:0 色度抽樣，適合圖片附註的裁切圖
+    img_byte_arr = io.BytesIO()
+    cropped_img.save(
+        img_byte_arr,
+        format='JPEG',
+        quality=85,
+        optimize=False,
+        progressive=False,
+        subsampling=2
+    )
+    return img_byte_arr.getvalue()
+
+def encode_for_gemini(image_input, image_bytes=None):
+    """
+    將圖片縮小並預先編碼為 JPEG，以 inline_data 形式上傳，
+    避免 SDK 內部把 PIL 物件重新編碼成體積較大的 PNG。
+    若原始上傳檔已是尺寸合適的 JPEG，直接沿用原檔 bytes。
+    """
+    if image_bytes is not None:
+        # 只讀取檔頭判斷格式與原始尺寸，不會解碼整張圖
+        with Image.open(io.BytesIO(image_bytes)) as source:
+            # 帶有 EXIF 旋轉資訊的檔案不沿用，以免座標與裁切用的像素方向不一致
+            orientation = source.getexif().get(0x0112, 1)
+            if source.format == 'JPEG' and orientation == 1 and max(source.size) <= GEMINI_MAX_SIDE:
+                return {'mime_type': 'image/jpeg', 'data': image_bytes}
+
+    # 縮小過大的圖片後再上傳；裁切仍使用主流程中的原圖，不影響輸出畫質
+    if max(image_input.size) > GEMINI_MAX_SIDE:
+        image_input = image_input.copy()
+        image_input.thumbnail((GEMINI_MAX_SIDE, GEMINI_MAX_SIDE), Image.Resampling.LANCZOS)
+
+    buf = io.BytesIO()
+    image_input.convert('RGB').save(buf, format='JPEG', quality=90, optimize=False)
+    return {'mime_type': 'image/jpeg', 'data': buf.getvalue()}
+
+def process_with_gemini(api_key, image_input, prompt=NEWSPAPER_PROMPT, image_bytes=None, cache=None, retry_log=None):
+    """
+    呼叫 Gemini API，依 prompt 進行報紙結構化分析，回傳解析後的 dict。
+    若提供 image_bytes 與 cache，先以內容雜湊查詢快取，命中時不呼叫 API。
+    回傳內容無法解析時直接拋出錯誤，不寫入快取。
+    """
+    try:
+        model = get_model(api_key)
+    except Exception as e:
+        raise ValueError(f"API 設定失敗: {e}")
+
+    cache_key = None
+    if cache is not None and image_bytes is not None:
+        cache_key = build_cache_key(image_bytes, prompt, MODEL_NAME)
+        cached_text = cache.get(cache_key)
+        if cached_text is not None:
+            return parse_page(cached_text)
+
+    result_text = generate_with_retry(
+        model,
+        [prompt, encode_for_gemini(image_input, image_bytes)],
+        generation_config=PAGE_GENERATION_CONFIG,
+        retry_log=retry_log
+    )
+
+    data = parse_page(result_text)
+    if cache_key is not None:
+        cache.set(cache_key, result_text, expire=CACHE_EXPIRE_SECONDS)
+    return data
+
+def load_image(file_bytes, high_res=False):
+    """
+    解碼上傳圖片；只在分析按鈕的流程中呼叫，不快取以免解碼後的整頁圖片常駐記憶體。
+    未開啟 high_res 時，JPEG 直接以縮小尺寸解碼 (非 JPEG 不受影響)。
+    """
+    image = Image.open(io.BytesIO(file_bytes))
+    if not high_res:
+        image.draft('RGB', DRAFT_SIZE)
+    return image.copy()
+
+def is_page_data(data):
+    """
+    檢查單張報紙結果是否為含有 sections 陣列的物件。
+    """
+    return isinstance(data, dict) and isinstance(data.get("sections"), list)
+
+def parse_page(result_text):
+    """
+    解析並驗證單張報紙的 JSON 結果，格式不符時拋出 ValueError。
+    在分析執行緒中呼叫，主執行緒只會拿到可直接使用的 dict。
+    """
+    try:
+        data = orjson.loads(result_text)
+    except orjson.JSONDecodeError as e:
+        raise ValueError(f"Gemini 回傳的 JSON 無法解析: {e}")
+
+    if not is_page_data(data):
+        raise ValueError("Gemini 回傳的 JSON 格式不符 (缺少 sections 陣列)")
+    return data
+
+def dump_json(obj):
+    """
+    以 UTF-8 bytes 輸出縮排 JSON (orjson 原生不跳脫中日文)，可直接寫入 ZIP。
+    """
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
+def split_pages(result_text, page_count):
+    """
+    拆解多張圖片請求回傳的 {"pages": [...]}，格式或數量不符時回傳 None。
+    """
+    try:
+        data = orjson.loads(result_text)
+    except orjson.JSONDecodeError:
+        return None
+
+    pages = data.get("pages") if isinstance(data, dict) else None
+    if not isinstance(pages, list) or len(pages) != page_count:
+        return None
+    if not all(is_page_data(page) for page in pages):
+        return None
+    return pages
+
+def process_pages_with_gemini(api_key, images, image_bytes_list, cache=None, retry_log=None):
+    """
+    將多張報紙圖片合併為一次 Gemini 請求，回傳與 images 等長的單張結果 dict。
+    每張圖片仍以單張 Prompt 的快取鍵各自快取；多頁結果格式不符時退回逐張分析。
+    """
+    if len(images) == 1:
+        return [process_with_gemini(
+            api_key,
+            images[0],
+            image_bytes=image_bytes_list[0],
+            cache=cache,
+            retry_log=retry_log
+        )]
+
+    # 先取出已快取的圖片，只把未命中的圖片送出
+    results = [None] * len(images)
+    cache_keys = [build_cache_key(b, NEWSPAPER_PROMPT, MODEL_NAME) for b in image_bytes_list]
+    if cache is not None:
+        for i, cache_key in enumerate(cache_keys):
+            cached_text = cache.get(cache_key)
+            if cached_text is not None:
+                results[i] = parse_page(cached_text)
+    pending = [i for i, result in enumerate(results) if result is None]
+
+    if len(pending) > 1:
+        try:
+            model = get_model(api_key)
+        except Exception as e:
+            raise ValueError(f"API 設定失敗: {e}")
+
+        prompt = NEWSPAPER_PROMPT + MULTI_PAGE_PROMPT_SUFFIX.format(page_count=len(pending))
+        result_text = generate_with_retry(
+            model,
+            [prompt] + [encode_for_gemini(images[i], image_bytes_list[i]) for i in pending],
+            generation_config=MULTI_PAGE_GENERATION_CONFIG,
+            retry_log=retry_log
+        )
+
+        pages = split_pages(result_text, len(pending))
+        if pages is not None:
+            for i, page in zip(pending, pages):
+                results[i] = page
+                if cache is not None:
+                    cache.set(cache_keys[i], orjson.dumps(page).decode("utf-8"), expire=CACHE_EXPIRE_SECONDS)
+            pending = []
+        else:
+            print(f"警告：多頁分析結果格式不符，改為逐張分析 {len(pending)} 張圖片")
+
+    # 單張未命中或多頁結果無法使用時，逐張分析
+    for i in pending:
+        results[i] = process_with_gemini(
+            api_key,
+            images[i],
+            image_bytes=image_bytes_list[i],
+            cache=cache,
+            retry_log=retry_log
+        )
+    return results
+
+def analyze_uploaded_files(api_key, uploaded_files, cache=None, retry_log=None, high_res=False):
+    """
+    載入一組上傳圖片並以一次 Gemini 請求分析，供執行緒池並行使用。
+    JSON 解析與驗證也在此執行緒完成，回傳 [(uploaded_file, image, data), ...]。
+    """
+    image_bytes_list = [uploaded_file.getvalue() for uploaded_file in uploaded_files]
+    images = [load_image(image_bytes, high_res) for image_bytes in image_bytes_list]
+    results = process_pages_with_gemini(
+        api_key,
+        images,
+        image_bytes_list,
+        cache=cache,
+        retry_log=retry_log
+    )
+    return list(zip(uploaded_files, images, results))
+
+# 資料夾名稱只保留文字、數字、底線與空白 (\w 即 str.isalnum() 加上底線)
+UNSAFE_TITLE_CHARS = re.compile(r'[^\w ]')
+
+# ZIP 內 JSON 成員的壓縮設定：文字壓縮效果好，使用最快的 DEFLATE 等級
+JSON_COMPRESSION = {"compress_type": zipfile.ZIP_DEFLATED, "compresslevel": 1}
+
+def build_page_entries(file_name, image, data):
+    """
+    將單張報紙的分析結果編碼為 ZIP 成員 (總表 JSON、各區塊 JSON 與圖片裁切)。
+    回傳 [(arcname, data, compression), ...]；可在背景執行緒執行，主執行緒只需寫入 ZIP。
+    """
+    base_filename = os.path.splitext(file_name)[0]
+    entries = []
+
+    # 重複上傳的檔案共用同一份 data，複製區塊後再修改 saved_image_path
+    sections = [dict(section) for section in data.get("sections", [])]
+    # 一次換算所有區塊的像素座標
+    pixel_boxes = section_pixel_boxes(sections, image.size)
+
+    # 1. 總表 JSON
+    full_json_path = f"{base_filename}/{base_filename}_full_report.json"
+    entries.append((full_json_path, dump_json(data), JSON_COMPRESSION))
+
+    # 2. 處理各個區塊
+    for i, section in enumerate(sections):
+        section_type = section.get('type', 'unknown')
+
+        # 命名資料夾
+        section_title = ""
+        if section_type == 'news':
+            section_title = section.get('headline_main_zh', '無標題')
+        elif section_type == 'image':
+            caption_snippet = section.get('caption_zh', '無附註')
+            section_title = f"圖片附註_{caption_snippet}"
+
+        # 清理檔名
+        safe_title = UNSAFE_TITLE_CHARS.sub('', section_title).strip()
+        safe_title = safe_title.replace(' ', '_')[:20] if safe_title else section_type
+        section_dir_name = f"{base_filename}/{i+1:02d}_{section_type}_{safe_title}"
+
+        # -----------------------------------------
+        # 圖片處理邏輯 (僅 type='image' 存圖)
+        # -----------------------------------------
+        if section_type == 'image':
+            img_bytes = crop_to_jpeg_bytes(image, pixel_boxes[i])
+            if img_bytes:
+                # 編碼好的圖片 bytes (JPEG 已壓縮，直接儲存)
+                img_path = f"{section_dir_name}/main_image.jpg"
+                entries.append((img_path, img_bytes, {}))
+
+                # 更新 JSON 紀錄路徑 (相對路徑)
+                section['saved_image_path'] = "main_image.jpg"
+        else:
+            # 新聞區塊不存圖，確保移除舊欄位
+            if 'saved_image_path' in section:
+                del section['saved_image_path']
+
+        # 單篇 JSON
+        section_json_path = f"{section_dir_name}/report_data.json"
+        entries.append((section_json_path, dump_json(section), JSON_COMPRESSION))
+
+    return entries
 
 # ---------------------------------------------------------
 # 側邊欄與輸入
@@ -129,12 +586,41 @@ with st.sidebar:
     st.header("⚙️ 設定")
     api_key_input = st.text_input("請輸入 Google AI Studio API Key", type="password")
     st.info("提示：此 Key 僅用於本次會話，不會被儲存。")
-    st.markdown("---")
-    st.markdown("**功能說明：**")
-    st.markdown("- 自動識別報紙分隔線")
-    st.markdown("- 大標/副標分離")
-    st.markdown("- 自動打包每篇報導為資料夾")
-    st.markdown("- **僅儲存圖片區塊的裁切圖**")
+    max_workers = st.slider(
+        "同時分析的圖片數量",
+        min_value=1,
+        max_value=8,
+        value=4,
+        help="並行呼叫 Gemini 的數量，若遇到流量限制 (RPM) 請調低。"
+    )
+    pages_per_request = st.slider(
+        "每次請求合併的圖片數量",
+        min_value=1,
+        max_value=4,
+        value=1,
+        help="將多張圖片合併為一次 Gemini 請求以減少往返次數；版面很密的報紙建議維持 1，避免超出輸出長度。"
+    )
+    high_res_crop = st.checkbox(
+        "高解析度裁切",
+        value=False,
+        help="以原始解析度解碼圖片，裁切圖較清晰但較耗記憶體與時間。"
+    )
+    if st.button("🗑️ 清除分析快取", help="清除已快取的 Gemini 分析結果，下次將重新呼叫 API。"):
+        get_response_cache().clear()
+        st.toast("已清除分析快取")
+    # 靜態說明合併為單一元素，每次重新執行只需比對一次
+    st.markdown(
+        "---\n"
+        "**功能說明：**\n"
+        "- 自動識別報紙分隔線\n"
+        "- 大標/副標分離\n"
+        "- 自動打包每篇報導為資料夾\n"
+        "- **僅儲存圖片區塊的裁切圖**\n\n"
+        "---"
+    )
+    # Pillow-SIMD 的版本號帶有 .postN 後綴
+    pil_backend = "Pillow-SIMD" if "post" in PIL.__version__ else "Pillow"
+    st.caption(f"影像處理：{pil_backend} {PIL.__version__}")
 
 uploaded_files = st.file_uploader("請選擇報紙圖片 (可多選)", type=["jpg", "jpeg", "png", "webp"], accept_multiple_files=True)
 
@@ -154,83 +640,111 @@ if st.button("🚀 開始分析並生成 ZIP", type="primary"):
     # 建立一個記憶體中的 ZIP 檔案
     zip_buffer = io.BytesIO()
     
-    # 用來顯示進度
-    progress_bar = st.progress(0)
-    status_text = st.empty()
+    total_files = len(uploaded_files)
+    failed_files = 0
 
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-        
-        total_files = len(uploaded_files)
-        
-        for idx, uploaded_file in enumerate(uploaded_files):
-            status_text.text(f"正在處理第 {idx+1}/{total_files} 張圖片：{uploaded_file.name} ...")
+    # 以單一狀態區塊顯示進度與錯誤訊息
+    with st.status(f"正在並行分析 {total_files} 張圖片 ...", expanded=True) as status:
+        # 預設不壓縮 (JPEG 再壓縮幾乎無效)，只有 JSON 成員另外以 DEFLATE 壓縮
+        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED) as zf:
             
-            try:
-                # 載入圖片
-                image = Image.open(uploaded_file)
-                base_filename = os.path.splitext(uploaded_file.name)[0]
-                
-                # 呼叫 Gemini
-                result_text = process_with_gemini(api_key_input, image)
-                
-                # 解析 JSON
-                data = json.loads(result_text)
-                sections = data.get("sections", [])
-                
-                # 1. 寫入總表 JSON
-                full_json_path = f"{base_filename}/{base_filename}_full_report.json"
-                zf.writestr(full_json_path, json.dumps(data, indent=2, ensure_ascii=False))
-                
-                # 2. 處理各個區塊
-                for i, section in enumerate(sections):
-                    section_type = section.get('type', 'unknown')
-                    box_2d = section.get('box_2d')
-                    
-                    # 命名資料夾
-                    section_title = ""
-                    if section_type == 'news':
-                        section_title = section.get('headline_main_zh', '無標題')
-                    elif section_type == 'image':
-                        caption_snippet = section.get('caption_zh', '無附註')
-                        section_title = f"圖片附註_{caption_snippet}"
-                    
-                    # 清理檔名
-                    safe_title = "".join(c for c in section_title if c.isalnum() or c in (' ', '_')).strip()
-                    safe_title = safe_title.replace(' ', '_')[:20] if safe_title else section_type
-                    section_dir_name = f"{base_filename}/{i+1:02d}_{section_type}_{safe_title}"
+            # 記錄本批次的重試事件 (list.append 在多執行緒下安全)
+            retry_log = []
+            # 快取物件在主執行緒取得後傳給各工作執行緒
+            response_cache = get_response_cache()
+            # 在並行請求送出前先建立模型與連線
+            get_model(api_key_input)
+            
+            # 同一批次中內容相同的檔案只分析一次，結果沿用給其他重複的檔案
+            unique_files = []
+            duplicate_files = {}
+            first_file_by_hash = {}
+            for uploaded_file in uploaded_files:
+                content_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+                first_file = first_file_by_hash.setdefault(content_hash, uploaded_file)
+                if first_file is uploaded_file:
+                    unique_files.append(uploaded_file)
+                    duplicate_files[uploaded_file] = []
+                else:
+                    duplicate_files[first_file].append(uploaded_file)
+            
+            # 依設定將圖片分組，每組合併為一次 Gemini 請求
+            file_groups = [
+                unique_files[i:i + pages_per_request]
+                for i in range(0, len(unique_files), pages_per_request)
+            ]
+            
+            # Gemini 呼叫為網路 I/O，交由執行緒池並行處理
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+            futures = {
+                executor.submit(
+                    analyze_uploaded_files,
+                    api_key_input,
+                    file_group,
+                    response_cache,
+                    retry_log,
+                    high_res_crop
+                ): file_group
+                for file_group in file_groups
+            }
+            
+            # 裁切編碼與 JSON 序列化為 CPU 工作，交由另一個執行緒池；ZIP 只在主執行緒寫入
+            encode_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+            encode_futures = {}
+            
+            done_files = 0
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in futures:
+                        # 分析完成：取出後即釋放 future，並把每一頁交給編碼執行緒池
+                        file_group = futures.pop(future)
+                        try:
+                            page_results = future.result()
+                        except Exception as e:
+                            for first_file in file_group:
+                                for uploaded_file in [first_file] + duplicate_files[first_file]:
+                                    done_files += 1
+                                    failed_files += 1
+                                    st.error(f"處理檔案 {uploaded_file.name} 時發生錯誤: {e}")
+                            continue
+                        
+                        for first_file, image, data in page_results:
+                            # 重複的檔案以各自的檔名輸出同一份分析結果
+                            for uploaded_file in [first_file] + duplicate_files[first_file]:
+                                encode_future = encode_executor.submit(
+                                    build_page_entries,
+                                    uploaded_file.name,
+                                    image,
+                                    data
+                                )
+                                encode_futures[encode_future] = uploaded_file
+                                pending.add(encode_future)
+                        continue
                     
-                    # -----------------------------------------
-                    # 圖片處理邏輯 (僅 type='image' 存圖)
-                    # -----------------------------------------
-                    if section_type == 'image':
-                        cropped_img = crop_image_section(image, box_2d)
-                        if cropped_img:
-                            # 將圖片轉為 bytes 寫入 zip
-                            img_byte_arr = io.BytesIO()
-                            cropped_img.save(img_byte_arr, format='JPEG')
-                            img_path = f"{section_dir_name}/main_image.jpg"
-                            zf.writestr(img_path, img_byte_arr.getvalue())
-                            
-                            # 更新 JSON 紀錄路徑 (相對路徑)
-                            section['saved_image_path'] = "main_image.jpg"
-                    else:
-                        # 新聞區塊不存圖，確保移除舊欄位
-                        if 'saved_image_path' in section:
-                            del section['saved_image_path']
+                    # 編碼完成：寫入 ZIP
+                    uploaded_file = encode_futures.pop(future)
+                    done_files += 1
+                    retry_note = f" (已重試 {len(retry_log)} 次)" if retry_log else ""
+                    status.update(label=f"已完成 {done_files}/{total_files} 張圖片：{uploaded_file.name}{retry_note}")
                     
-                    # 寫入單篇 JSON
-                    section_json_path = f"{section_dir_name}/report_data.json"
-                    zf.writestr(section_json_path, json.dumps(section, indent=2, ensure_ascii=False))
-
-            except Exception as e:
-                st.error(f"處理檔案 {uploaded_file.name} 時發生錯誤: {e}")
+                    try:
+                        for arcname, payload, compression in future.result():
+                            zf.writestr(arcname, payload, **compression)
+                    except Exception as e:
+                        failed_files += 1
+                        st.error(f"處理檔案 {uploaded_file.name} 時發生錯誤: {e}")
             
-            # 更新進度條
-            progress_bar.progress((idx + 1) / total_files)
-
-    status_text.text("✅ 所有處理完成！準備下載...")
-    progress_bar.progress(1.0)
+            executor.shutdown(wait=True)
+            encode_executor.shutdown(wait=True)
+        
+        # 有錯誤時保持展開，讓使用者看到錯誤訊息
+        status.update(label="✅ 所有處理完成！準備下載...", state="complete", expanded=failed_files > 0)
     
+    if retry_log:
+        st.toast(f"🔁 本批次共重試 {len(retry_log)} 次 Gemini 請求 (流量限制或暫時性錯誤)")
+
     # 讓指針回到開始位置
     zip_buffer.seek(0)
     
@@ -241,6 +755,8 @@ if st.button("🚀 開始分析並生成 ZIP", type="primary"):
         data=zip_buffer,
         file_name=f"newspaper_analysis_{timestamp}.zip",
         mime="application/zip",
+        # 下載時不觸發重新執行，避免整個頁面與結果被清空重算
+        on_click="ignore",
         type="primary"
     )
     